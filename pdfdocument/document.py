@@ -1,21 +1,33 @@
 # coding=utf-8
 
 import copy
+import hashlib
+import os
+import pickle
 import sys
+import time
 import unicodedata
+from fnmatch import fnmatch
 from functools import reduce
+from itertools import repeat
+from weakref import WeakKeyDictionary
 
+import reportlab
+from reportlab import rl_config
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_RIGHT
 from reportlab.lib.fonts import addMapping
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import cm, mm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfbase import pdfmetrics, ttfonts
+from reportlab.pdfbase.ttfonts import TTEncoding, TTFont
 from reportlab.platypus import (
     BaseDocTemplate,
     CondPageBreak,
+    Flowable,
     Frame,
+    FrameBreak,
     KeepTogether,
     NextPageTemplate,
     PageBreak,
@@ -26,6 +38,8 @@ from reportlab.platypus import (
 )
 from reportlab.platypus.flowables import HRFlowable
 
+from pdfdocument.stats import DocumentStats, collector
+
 
 PY2 = sys.version_info[0] < 3
 
@@ -35,18 +49,130 @@ else:
     string_type = str
 
 
+# Parsed TTFont objects, keyed by absolute path
+_parsed_fonts = {}
+
+
+def _pdf_scale(units_per_em):
+    if units_per_em == 1000:
+        return lambda x: x
+    return lambda x: x * (1000 / units_per_em)
+
+
+def _is_trusted(cache_file):
+    """
+    Only load cache files owned by the current user and not writable by
+    others, since unpickling a file may execute arbitrary code
+    """
+    if not hasattr(os, "getuid"):
+        return True
+    stat = os.stat(cache_file)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def _parse_font(path, cache_dir=None):
+    """
+    Return a parsed ``TTFont`` for the path. Each file is only parsed once
+    per process. If ``cache_dir`` is given, parsed fonts are additionally
+    pickled there, keyed by the hash of the file's contents. Caching is best
+    effort, failures to read or write the cache are ignored.
+    """
+    if path in _parsed_fonts:
+        return _parsed_fonts[path]
+
+    font = cache_file = None
+    if cache_dir:
+        with open(path, "rb") as handle:
+            digest = hashlib.sha1(handle.read()).hexdigest()
+        cache_file = os.path.join(
+            cache_dir, "%s-%s.pickle" % (digest, reportlab.Version)
+        )
+
+        try:
+            if _is_trusted(cache_file):
+                with open(cache_file, "rb") as handle:
+                    font = pickle.load(handle)
+                font.state = WeakKeyDictionary()
+                font.face.filename = path
+                font.face._pdfScale = _pdf_scale(font.face.unitsPerEm)
+        except Exception:
+            font = None
+
+    if font is None:
+        font = TTFont(os.path.basename(path), path)
+
+        if cache_file:
+            tmp_file = "%s.%s.tmp" % (cache_file, os.getpid())
+            try:
+                # The scaling function and the per-document state cannot be
+                # pickled, they are recreated when loading the font.
+                face = copy.copy(font.face)
+                del face._pdfScale
+                cached = copy.copy(font)
+                cached.face = face
+                cached.state = None
+
+                fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "wb") as handle:
+                    pickle.dump(cached, handle, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_file, cache_file)
+            except Exception:
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+    _parsed_fonts[path] = font
+    return font
+
+
+def _register_font(name, path, cache_dir=None):
+    path = os.path.abspath(path)
+
+    if name in pdfmetrics.getRegisteredFontNames():
+        face = getattr(pdfmetrics.getFont(name), "face", None)
+        if getattr(face, "filename", None) == path:
+            return
+
+    # Fonts sharing a file also share the parsed face, but need their own
+    # name, encoding and per-document state. The remaining settings are
+    # recomputed the same way as in TTFont.__init__.
+    font = copy.copy(_parse_font(path, cache_dir))
+    font.fontName = name
+    font.encoding = TTEncoding()
+    font.state = WeakKeyDictionary()
+    font._asciiReadable = rl_config.ttfAsciiReadable
+    if hasattr(font, "shapable"):
+        font.shapable = not any(
+            fnmatch(name, glob)
+            for glob in getattr(ttfonts, "unShapedFontGlob", None) or ()
+        )
+    pdfmetrics.registerFont(font)
+
+
 def register_fonts_from_paths(
-    regular, italic=None, bold=None, bolditalic=None, font_name="Reporting"
+    regular,
+    italic=None,
+    bold=None,
+    bolditalic=None,
+    font_name="Reporting",
+    cache_dir=None,
 ):
     """
     Pass paths to TTF files which should be used for the PDFDocument
+
+    Registering the same fonts again is a no-op, and every file is only
+    parsed once. Pass ``cache_dir`` to additionally cache parsed fonts on
+    disk, which speeds up loading big Unicode fonts in new processes. The
+    cache files are pickles, so ``cache_dir`` must be a private directory
+    which is only writable by trusted users.
     """
 
-    pdfmetrics.registerFont(TTFont("%s" % font_name, regular))
-    pdfmetrics.registerFont(TTFont("%s-Italic" % font_name, italic or regular))
-    pdfmetrics.registerFont(TTFont("%s-Bold" % font_name, bold or regular))
-    pdfmetrics.registerFont(
-        TTFont("%s-BoldItalic" % font_name, bolditalic or bold or regular)
+    _register_font("%s" % font_name, regular, cache_dir)
+    _register_font("%s-Italic" % font_name, italic or regular, cache_dir)
+    _register_font("%s-Bold" % font_name, bold or regular, cache_dir)
+    _register_font(
+        "%s-BoldItalic" % font_name, bolditalic or bold or regular, cache_dir
     )
 
     addMapping("%s" % font_name, 0, 0, "%s" % font_name)
@@ -59,6 +185,52 @@ class Empty(object):
     pass
 
 
+ADDRESS_FIELDS = (
+    "company",
+    "manner_of_address",
+    "first_name",
+    "last_name",
+    "address",
+    "zip_code",
+    "city",
+    "full_override",
+)
+
+
+def address_lines(
+    company,
+    manner_of_address,
+    first_name,
+    last_name,
+    address,
+    zip_code,
+    city,
+    full_override,
+):
+    """
+    Return the lines of an address block
+    """
+    if full_override:
+        return [line.strip() for line in full_override.replace("\r", "").splitlines()]
+
+    lines = []
+    if company:
+        lines.append(company)
+
+    title = manner_of_address
+    if title:
+        title += u" "
+
+    if first_name:
+        lines.append(u"%s%s %s" % (title, first_name, last_name))
+    else:
+        lines.append(u"%s%s" % (title, last_name))
+
+    lines.append(address)
+    lines.append(u"%s %s" % (zip_code, city))
+    return lines
+
+
 def sanitize(text):
     REPLACE_MAP = [
         (u"&", "&#38;"),
@@ -107,9 +279,77 @@ class BottomTable(Table):
     pass
 
 
+class TextBlock(Flowable):
+    """
+    Block of plain text lines which is not parsed for markup, which makes it
+    much cheaper to create than a Paragraph. Lines are wrapped to the
+    available width. If ``shrink`` is set, text which is too tall for the
+    available space is scaled down instead of being split.
+    """
+
+    def __init__(self, lines, style, shrink=False):
+        Flowable.__init__(self)
+        self.lines = lines
+        self.style = style
+        self.shrink = shrink
+        self._scale = 1
+
+    def wrap(self, availWidth, availHeight):
+        self._wrapped = []
+        for line in self.lines:
+            self._wrapped.extend(
+                simpleSplit(line, self.style.fontName, self.style.fontSize, availWidth)
+                or [u""]
+            )
+        self.width = availWidth
+        self.height = len(self._wrapped) * self.style.leading
+        self._scale = 1
+        if self.shrink and self.height > availHeight > 0:
+            self._scale = availHeight / float(self.height)
+            self.height = availHeight
+        return (self.width, self.height)
+
+    def split(self, availWidth, availHeight):
+        if self.shrink:
+            return []
+        self.wrap(availWidth, availHeight)
+        count = int(availHeight // self.style.leading)
+        if count <= 0 or count >= len(self._wrapped):
+            return []
+        return [
+            TextBlock(self._wrapped[:count], self.style),
+            TextBlock(self._wrapped[count:], self.style),
+        ]
+
+    def draw(self):
+        self.canv.saveState()
+        self.canv.scale(self._scale, self._scale)
+        text = self.canv.beginText(0, self.height / self._scale - self.style.fontSize)
+        text.setFont(self.style.fontName, self.style.fontSize, self.style.leading)
+        text.setFillColor(self.style.textColor)
+        for line in self._wrapped:
+            text.textLine(line)
+        self.canv.drawText(text)
+        self.canv.restoreState()
+
+
 class BottomSpacer(Spacer):
+    """
+    Fills the space above the following ``BottomTable``. The table is measured
+    against the available width when wrapping the spacer, so its height is
+    already known in the first layout pass. If no table is passed, the
+    ``BottomTable`` directly following the spacer in the story is used.
+    """
+
+    def __init__(self, width, height, table=None):
+        Spacer.__init__(self, width, height)
+        self._table = table
+
     def wrap(self, availWidth, availHeight):
-        my_height = availHeight - self._doc.bottomTableHeight
+        table_height = 0
+        if self._table is not None:
+            table_height = self._table.wrap(availWidth, availHeight)[1]
+        my_height = availHeight - table_height
 
         if my_height <= 0:
             return (self.width, availHeight)
@@ -125,29 +365,105 @@ class RestartPageBreak(PageBreak):
     pass
 
 
+class LimitExceeded(Exception):
+    """
+    Raised when generating a document exceeds one of the resource limits
+    passed to ``PDFDocument``. The attributes describe where layout was
+    aborted; ``flowable`` is the flowable which was being laid out and
+    ``index`` the position of the story item it belongs to. ``page`` is 0 if
+    the limit was exceeded before laying out any page of the pass.
+    """
+
+    def __init__(
+        self, limit, maximum, value, page=0, passes=0, flowable=None, index=None
+    ):
+        self.limit = limit
+        self.maximum = maximum
+        self.value = value
+        self.page = page
+        self.passes = passes
+        self.flowable = flowable
+        self.index = index
+
+        message = "%s limit of %s exceeded (%s)" % (limit, maximum, value)
+        if page:
+            message += " on page %d" % page
+        message += " in pass %d" % passes
+        if flowable is not None:
+            message += ", while laying out story item %s: %s" % (
+                index,
+                flowable.identity(60),
+            )
+        Exception.__init__(self, message)
+
+
 class ReportingDocTemplate(BaseDocTemplate):
     def __init__(self, *args, **kwargs):
         BaseDocTemplate.__init__(self, *args, **kwargs)
+        self.setProgressCallBack(self._onProgress_cb)
+
+        # Resource limits, None means unlimited
+        self.maxPages = kwargs.get("max_pages")
+        self.maxPasses = kwargs.get("max_passes")
+        self.maxStorySize = kwargs.get("max_story_size")
+        self.timeLimit = kwargs.get("time_limit")
+
+        self.reset()
+
+    def reset(self, filename=None):
+        """
+        Reset the state collected while building a document, optionally
+        pointing the template at a new output file. Page templates are kept.
+        """
+        if filename is not None:
+            self.filename = filename
+
         self.bottomTableHeight = 0
-        self.bottomTableIsLast = False
         self.numPages = 0
         self._lastNumPages = 0
-        self.setProgressCallBack(self._onProgress_cb)
+
+        self._passes = 0
+        self._started = None
+        self._currentFlowable = None
+        self._currentIndex = None
+        self._storyIndex = {}
 
         # For batch reports with several PDFs concatenated
         self.restartDoc = False
         self.restartDocIndex = 0
         self.restartDocPageNumbers = []
 
+        self._pageRefs = {}
+        self._indexingFlowables = []
+
+    def build(self, flowables, *args, **kwargs):
+        # Positions of the top level story items, used for diagnostics
+        self._storyIndex = dict((id(f), i) for i, f in enumerate(flowables))
+        BaseDocTemplate.build(self, flowables, *args, **kwargs)
+
+    def handle_flowable(self, flowables):
+        if flowables:
+            self._currentFlowable = flowables[0]
+            # Flowables produced by splitting keep the index of their item
+            self._currentIndex = self._storyIndex.get(
+                id(flowables[0]), self._currentIndex
+            )
+            if (
+                isinstance(flowables[0], BottomSpacer)
+                and flowables[0]._table is None
+                and len(flowables) > 1
+                and isinstance(flowables[1], BottomTable)
+            ):
+                flowables[0]._table = flowables[1]
+        BaseDocTemplate.handle_flowable(self, flowables)
+
     def afterFlowable(self, flowable):
         self.numPages = max(self.canv.getPageNumber(), self.numPages)
-        self.bottomTableIsLast = False
+        self._checkLimits()
 
         if isinstance(flowable, BottomTable):
             self.bottomTableHeight = reduce(lambda p, q: p + q, flowable._rowHeights, 0)
 
-            self.bottomTableIsLast = True
-
         elif isinstance(flowable, RestartPageBreak):
             self.restartDoc = True
             self.restartDocIndex += 1
@@ -164,7 +480,43 @@ class ReportingDocTemplate(BaseDocTemplate):
         if what == "STARTED":
             self._lastNumPages = self.numPages
             self.restartDocIndex = 0
+            self._currentFlowable = None
+            self._currentIndex = None
             # self.restartDocPageNumbers = []
+        elif what == "PASS":
+            self._passes = arg
+            self._currentFlowable = None
+            self._currentIndex = None
+            if arg == 1:
+                self._started = time.time()
+            if self.maxPasses is not None and arg > self.maxPasses:
+                self._limitExceeded("passes", self.maxPasses, arg, page=0)
+        elif what == "SIZE_EST":
+            if self.maxStorySize is not None and arg > self.maxStorySize:
+                self._limitExceeded("story size", self.maxStorySize, arg, page=0)
+        elif what in ("PROGRESS", "PAGE"):
+            self._checkLimits()
+
+    def _checkLimits(self):
+        if self.maxPages is not None:
+            page = self.canv.getPageNumber()
+            if page > self.maxPages:
+                self._limitExceeded("pages", self.maxPages, page)
+        if self.timeLimit is not None and self._started is not None:
+            elapsed = time.time() - self._started
+            if elapsed > self.timeLimit:
+                self._limitExceeded("time", self.timeLimit, elapsed)
+
+    def _limitExceeded(self, limit, maximum, value, page=None):
+        raise LimitExceeded(
+            limit,
+            maximum,
+            value,
+            page=self.page if page is None else page,
+            passes=self._passes,
+            flowable=self._currentFlowable,
+            index=self._currentIndex,
+        )
 
     def page_index(self):
         """
@@ -198,12 +550,6 @@ class ReportingDocTemplate(BaseDocTemplate):
             else:
                 total_pages = self.restartDocPageNumbers[0]
 
-        if self.bottomTableHeight:
-            total_pages -= 1
-
-            if self.bottomTableIsLast and current_page == 1:
-                total_pages = max(1, total_pages)
-
         # Ensure total pages is always at least 1
         total_pages = max(1, total_pages)
 
@@ -222,8 +568,25 @@ def dummy_stationery(c, doc):
     pass
 
 
+def _output_size(filename):
+    """
+    Return the current size of the output file or file-like object, or
+    ``None`` if it cannot be determined cheaply
+    """
+    try:
+        if isinstance(filename, string_type):
+            return os.path.getsize(filename)
+        return filename.tell()
+    except Exception:
+        return None
+
+
 class PDFDocument(object):
     show_boundaries = False
+    template = None
+    stats = None
+    _initial_story = ()
+    _addresses_added = False
     _watermark = None
 
     def __init__(self, *args, **kwargs):
@@ -234,6 +597,20 @@ class PDFDocument(object):
         self.font_name = kwargs.get("font_name", "Helvetica")
         self.font_size = kwargs.get("font_size", 9)
 
+    def reset(self, filename):
+        """
+        Prepare this instance for generating another document into
+        ``filename``, reusing the page templates, frames and styles created
+        by ``init_report``, ``init_letter`` and friends. The story is reset to
+        the flowables added by those methods.
+        """
+        self.doc.reset(filename)
+        self.story = list(self._initial_story)
+        self._watermark = None
+        self.stats = None
+        self._addresses_added = False
+        self.__dict__.pop("keeptogether_index", None)
+
     def page_index_string(self, current_page, total_pages):
         return "Page %(current_page)d of %(total_pages)d" % {
             "current_page": current_page,
@@ -373,6 +750,8 @@ class PDFDocument(object):
             ]
         )
         self.story.append(NextPageTemplate("Later"))
+        self._initial_story = list(self.story)
+        self.template = "custom"
 
     def init_report(self, page_fn=dummy_stationery, page_fn_later=None):
         frame_kwargs = {
@@ -394,7 +773,9 @@ class PDFDocument(object):
             ]
         )
         self.story.append(NextPageTemplate("Later"))
+        self._initial_story = list(self.story)
 
+        self.template = "report"
         self.generate_style()
 
     def init_confidential_report(self, page_fn=dummy_stationery, page_fn_later=None):
@@ -407,6 +788,7 @@ class PDFDocument(object):
             doc.PDFDocument.watermark("CONFIDENTIAL")
 
         self.init_report(page_fn=_first_page_fn, page_fn_later=page_fn_later)
+        self.template = "confidential_report"
 
     def init_letter(
         self,
@@ -444,7 +826,57 @@ class PDFDocument(object):
             ]
         )
         self.story.append(NextPageTemplate("Later"))
+        self._initial_story = list(self.story)
 
+        self.template = "letter"
+        self.generate_style()
+
+    def init_labels(
+        self,
+        page_fn=dummy_stationery,
+        columns=3,
+        rows=8,
+        label_width=7 * cm,
+        label_height=3.7 * cm,
+        left=0,
+        bottom=0.05 * cm,
+        padding=0.5 * cm,
+    ):
+        """
+        Initialize a page template with a grid of frames for printing many
+        address labels per page, see ``addresses``. The defaults fit A4 sheets
+        with 3 by 8 labels of 70 x 37 mm.
+        """
+        frame_kwargs = {
+            "showBoundary": self.show_boundaries,
+            "leftPadding": padding,
+            "rightPadding": padding,
+            "topPadding": padding,
+            "bottomPadding": padding,
+        }
+
+        frames = [
+            Frame(
+                left + column * label_width,
+                bottom + (rows - row - 1) * label_height,
+                label_width,
+                label_height,
+                **frame_kwargs
+            )
+            for row in range(rows)
+            for column in range(columns)
+        ]
+
+        self.doc.addPageTemplates(
+            [
+                PageTemplate(id="First", frames=frames, onPage=page_fn),
+                PageTemplate(id="Later", frames=frames, onPage=page_fn),
+            ]
+        )
+        self.story.append(NextPageTemplate("Later"))
+        self._initial_story = list(self.story)
+
+        self.template = "labels"
         self.generate_style()
 
     def watermark(self, watermark=None):
@@ -572,17 +1004,48 @@ class PDFDocument(object):
         self.story.append(PageBreak())
 
     def bottom_table(self, data, columns, style=None):
-        obj = BottomSpacer(1, 1)
-        obj._doc = self.doc
-        self.story.append(obj)
+        table = BottomTable(data, columns, style=style or self.style.table)
 
-        self.story.append(BottomTable(data, columns, style=style or self.style.table))
+        self.story.append(BottomSpacer(1, 1, table=table))
+        self.story.append(table)
 
     def append(self, data):
         self.story.append(data)
 
     def generate(self):
-        self.doc.multiBuild(self.story)
+        """
+        Build the document and return its ``DocumentStats``, which are also
+        recorded in ``pdfdocument.stats.collector``. Failed builds are
+        recorded too before the exception is propagated.
+        """
+        started = time.time()
+        if isinstance(self.doc.filename, string_type):
+            offset = 0
+        else:
+            offset = _output_size(self.doc.filename)
+
+        outcome = "error"
+        try:
+            if self.doc.maxPasses is not None:
+                self.doc.multiBuild(self.story, maxPasses=self.doc.maxPasses)
+            else:
+                self.doc.multiBuild(self.story)
+            outcome = "success"
+        except LimitExceeded:
+            outcome = "limit_exceeded"
+            raise
+        finally:
+            size = _output_size(self.doc.filename) if outcome == "success" else None
+            self.stats = DocumentStats(
+                template=self.template or "custom",
+                pages=self.doc.numPages,
+                passes=self.doc._passes,
+                bytes=None if size is None or offset is None else size - offset,
+                seconds=time.time() - started,
+                outcome=outcome,
+            )
+            collector.record(self.stats)
+        return self.stats
 
     def confidential(self, canvas):
         canvas.saveState()
@@ -654,42 +1117,57 @@ class PDFDocument(object):
             data = obj
         else:
             data = {}
-            for field in (
-                "company",
-                "manner_of_address",
-                "first_name",
-                "last_name",
-                "address",
-                "zip_code",
-                "city",
-                "full_override",
-            ):
+            for field in ADDRESS_FIELDS:
                 attribute = "%s%s" % (prefix, field)
                 data[field] = getattr(obj, attribute, u"").strip()
 
-        address = []
-        if data.get("company", False):
-            address.append(data["company"])
-
-        title = data.get("manner_of_address", "")
-        if title:
-            title += u" "
+        self.p("\n".join(address_lines(*[data.get(f, "") for f in ADDRESS_FIELDS])))
 
-        if data.get("first_name", False):
-            address.append(
-                u"%s%s %s"
-                % (title, data.get("first_name", ""), data.get("last_name", ""))
-            )
+    def addresses(self, data, fields=ADDRESS_FIELDS, style=None):
+        """
+        Add many address blocks at once, each in its own frame (for example
+        using ``init_labels``). The addresses are formatted like ``address``
+        but rendered as plain ``TextBlock`` flowables without markup parsing.
+        Addresses too tall for their frame are shrunk to fit.
+
+        ``data`` is either a dict mapping field names to sequences of values,
+        or a sequence of rows such as ``values_list()`` querysets, whose
+        values are in the order of ``fields``. Missing fields are left empty.
+        """
+        if isinstance(data, dict):
+            columns = data
+            if len(set(len(column) for column in columns.values())) > 1:
+                raise ValueError("All address columns must have the same length")
         else:
-            address.append(u"%s%s" % (title, data.get("last_name", "")))
-
-        address.append(data.get("address"))
-        address.append(u"%s %s" % (data.get("zip_code", ""), data.get("city", "")))
-
-        if data.get("full_override"):
-            address = [
-                l.strip()
-                for l in data.get("full_override").replace("\r", "").splitlines()
-            ]
-
-        self.p("\n".join(address))
+            rows = list(data)
+            if any(len(row) != len(fields) for row in rows):
+                raise ValueError("All address rows must have %d values" % len(fields))
+            columns = dict(zip(fields, zip(*rows) if rows else [()] * len(fields)))
+
+        unknown = set(columns) - set(ADDRESS_FIELDS)
+        if unknown:
+            raise ValueError("Unknown address fields: %s" % ", ".join(sorted(unknown)))
+        if not columns:
+            return
+
+        cleaned = [
+            [u"" if value is None else string_type(value).strip() for value in column]
+            if column is not None
+            else repeat(u"")
+            for column in (columns.get(field) for field in ADDRESS_FIELDS)
+        ]
+        texts = [u"\n".join(address_lines(*values)) for values in zip(*cleaned)]
+        if not texts:
+            return
+
+        # Normalize all addresses in one go
+        parts = normalize(u"\x00".join(texts)).split(u"\x00")
+        if len(parts) != len(texts):
+            parts = [normalize(text) for text in texts]
+
+        style = style or self.style.normal
+        for text in parts:
+            if self._addresses_added:
+                self.story.append(FrameBreak())
+            self._addresses_added = True
+            self.story.append(TextBlock(text.split(u"\n"), style, shrink=True))
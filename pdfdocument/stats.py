@@ -0,0 +1,152 @@
+import threading
+import time
+from bisect import bisect_left
+
+
+BUCKETS = {
+    "pages": (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    "passes": (1, 2, 3, 4, 5, 10),
+    "bytes": (10000, 50000, 100000, 500000, 1000000, 5000000, 10000000, 50000000),
+    "seconds": (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60),
+}
+
+
+class DocumentStats(object):
+    """
+    Numbers collected while generating a single document
+    """
+
+    def __init__(self, template, pages, passes, bytes, seconds, outcome="success"):
+        self.template = template
+        self.pages = pages
+        self.passes = passes
+        self.bytes = bytes
+        self.seconds = seconds
+        # "success", "limit_exceeded" or "error"
+        self.outcome = outcome
+
+    def __repr__(self):
+        return (
+            "<DocumentStats template=%s outcome=%s pages=%s passes=%s bytes=%s"
+            " seconds=%.3f>"
+            % (
+                self.template,
+                self.outcome,
+                self.pages,
+                self.passes,
+                self.bytes,
+                self.seconds,
+            )
+        )
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def dump(self):
+        return {
+            "buckets": list(zip(self.buckets + ("+Inf",), self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class StatsCollector(object):
+    """
+    Aggregates the stats of all documents generated in this process as
+    histograms per template type and outcome
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.documents = 0
+            # (template, outcome) -> {metric: Histogram}
+            self.histograms = {}
+
+    def record(self, stats):
+        with self._lock:
+            self.documents += 1
+            key = (stats.template, stats.outcome)
+            histograms = self.histograms.get(key)
+            if histograms is None:
+                histograms = self.histograms[key] = {
+                    metric: Histogram(buckets) for metric, buckets in BUCKETS.items()
+                }
+            for metric, histogram in histograms.items():
+                value = getattr(stats, metric)
+                if value is not None:
+                    histogram.observe(value)
+
+    def dump(self):
+        """
+        Return the collected numbers as a dictionary. ``documents`` in
+        ``templates`` counts all documents, the histograms only contain
+        documents for which the metric is known.
+        """
+        with self._lock:
+            minutes = max(time.time() - self.started, 1) / 60.0
+            templates = {}
+            for (template, outcome), histograms in self.histograms.items():
+                templates.setdefault(template, {})[outcome] = {
+                    "documents": histograms["seconds"].count,
+                    "metrics": {
+                        metric: histogram.dump()
+                        for metric, histogram in histograms.items()
+                    },
+                }
+            return {
+                "documents": self.documents,
+                "documents_per_minute": self.documents / minutes,
+                "templates": templates,
+            }
+
+    def prometheus(self):
+        """
+        Return the collected numbers in the Prometheus text format
+        """
+        data = self.dump()
+        series = sorted(
+            (template, outcome, values)
+            for template, outcomes in data["templates"].items()
+            for outcome, values in outcomes.items()
+        )
+
+        lines = ["# TYPE pdfdocument_documents_total counter"]
+        for template, outcome, values in series:
+            lines.append(
+                'pdfdocument_documents_total{template="%s",outcome="%s"} %d'
+                % (template, outcome, values["documents"])
+            )
+
+        for metric in sorted(BUCKETS):
+            name = "pdfdocument_document_%s" % metric
+            lines.append("# TYPE %s histogram" % name)
+            for template, outcome, values in series:
+                histogram = values["metrics"][metric]
+                labels = 'template="%s",outcome="%s"' % (template, outcome)
+                cumulative = 0
+                for le, count in histogram["buckets"]:
+                    cumulative += count
+                    lines.append(
+                        '%s_bucket{%s,le="%s"} %d' % (name, labels, le, cumulative)
+                    )
+                lines.append("%s_sum{%s} %s" % (name, labels, histogram["sum"]))
+                lines.append("%s_count{%s} %d" % (name, labels, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+collector = StatsCollector()
@@ -0,0 +1,427 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase, mock
+
+import reportlab
+from reportlab import rl_config
+from reportlab.lib.units import cm
+from reportlab.pdfbase import pdfmetrics, ttfonts
+from reportlab.platypus import Frame, KeepTogether, PageTemplate, Table
+
+from pdfdocument import document
+from pdfdocument.document import (
+    BottomSpacer,
+    BottomTable,
+    LimitExceeded,
+    PDFDocument,
+    TextBlock,
+    register_fonts_from_paths,
+)
+from pdfdocument.stats import collector
+
+
+VERA = os.path.join(os.path.dirname(reportlab.__file__), "fonts", "Vera.ttf")
+
+
+def build(lines, bottom_table=True, direct=False):
+    """
+    Generate a report with ``lines`` paragraphs followed by a bottom table,
+    and return the document, the number of passes, the page index strings of
+    the last pass and the page and y position of the bottom table
+    """
+    pdf = PDFDocument(BytesIO())
+    pdf.init_report(page_fn=lambda canvas, doc: indexes.append(doc.page_index()))
+
+    indexes = []
+    passes = []
+    tables = []
+
+    on_progress = pdf.doc._onProgress_cb
+
+    def _on_progress(what, arg):
+        if what == "STARTED":
+            passes.append(arg)
+            del indexes[:], tables[:]
+        on_progress(what, arg)
+
+    pdf.doc.setProgressCallBack(_on_progress)
+
+    after_flowable = pdf.doc.afterFlowable
+
+    def _after_flowable(flowable):
+        if isinstance(flowable, BottomTable):
+            tables.append((pdf.doc.page, round(pdf.doc.frame._y, 2)))
+        after_flowable(flowable)
+
+    pdf.doc.afterFlowable = _after_flowable
+
+    for i in range(lines):
+        pdf.p("Line %d" % i)
+    if bottom_table:
+        data = [["Total", "%d" % i] for i in range(5)]
+        if direct:
+            pdf.append(BottomSpacer(1, 1))
+            pdf.append(BottomTable(data, (10 * cm, 4 * cm), style=pdf.style.table))
+        else:
+            pdf.bottom_table(data, (10 * cm, 4 * cm))
+
+    pdf.generate()
+    return pdf, len(passes), indexes, tables
+
+
+class BottomTableTest(TestCase):
+    def test_single_page(self):
+        pdf, passes, indexes, tables = build(10)
+        self.assertEqual(passes, 2)
+        self.assertEqual(indexes, [(1, 1)])
+        # The table ends at the bottom of the frame
+        self.assertEqual(tables, [(1, round(2 * cm, 2))])
+
+    def test_passes_unchanged(self):
+        self.assertEqual(build(10, bottom_table=False)[1], build(10)[1])
+
+    def test_spills_onto_new_page(self):
+        # Enough lines to leave no room for the table on the first page
+        pdf, passes, indexes, tables = build(74)
+        self.assertEqual(passes, 2)
+        self.assertEqual(indexes, [(1, 2), (2, 2)])
+        self.assertEqual(tables, [(2, round(2 * cm, 2))])
+
+    def test_many_pages(self):
+        pdf, passes, indexes, tables = build(200)
+        self.assertEqual(indexes, [(1, 4), (2, 4), (3, 4), (4, 4)])
+        self.assertEqual(tables, [(4, round(2 * cm, 2))])
+
+    def test_bottom_spacer_without_table(self):
+        pdf, passes, indexes, tables = build(10, direct=True)
+        self.assertEqual(passes, 2)
+        self.assertEqual(indexes, [(1, 1)])
+        self.assertEqual(tables, [(1, round(2 * cm, 2))])
+
+
+class FontCacheTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        document._parsed_fonts.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        document._parsed_fonts.clear()
+
+    def test_cache(self):
+        register_fonts_from_paths(VERA, font_name="CacheTest", cache_dir=self.cache_dir)
+        (cache_file,) = os.listdir(self.cache_dir)
+        cache_file = os.path.join(self.cache_dir, cache_file)
+        self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+
+        document._parsed_fonts.clear()
+        font = document._parse_font(VERA, self.cache_dir)
+        self.assertEqual(font.face.filename, VERA)
+
+        # Files writable by others are not loaded
+        os.chmod(cache_file, 0o666)
+        document._parsed_fonts.clear()
+        self.assertFalse(document._is_trusted(cache_file))
+        document._parse_font(VERA, self.cache_dir)
+        self.assertTrue(document._is_trusted(cache_file))
+
+    def test_idempotent(self):
+        bold = os.path.join(os.path.dirname(VERA), "VeraBd.ttf")
+        with mock.patch("pdfdocument.document.TTFont", wraps=document.TTFont) as ttfont:
+            register_fonts_from_paths(VERA, bold=bold, font_name="Idempotent")
+            register_fonts_from_paths(VERA, bold=bold, font_name="Idempotent")
+        # Every file is parsed once
+        self.assertEqual(ttfont.call_count, 2)
+
+        fonts = dict(
+            (suffix, pdfmetrics.getFont("Idempotent%s" % suffix))
+            for suffix in ("", "-Italic", "-Bold", "-BoldItalic")
+        )
+        self.assertIs(fonts[""].face, fonts["-Italic"].face)
+        self.assertIs(fonts["-Bold"].face, fonts["-BoldItalic"].face)
+        self.assertIsNot(fonts[""].face, fonts["-Bold"].face)
+
+        # Registering again does not replace the registered fonts
+        register_fonts_from_paths(VERA, bold=bold, font_name="Idempotent")
+        self.assertIs(pdfmetrics.getFont("Idempotent-Bold"), fonts["-Bold"])
+
+    def test_shapable(self):
+        # Settings depending on the name match those of a TTFont created
+        # with the registered name, not with the name of the parsed file
+        with mock.patch.object(
+            ttfonts, "unShapedFontGlob", ["Unshaped*"]
+        ), mock.patch.object(pdfmetrics, "registerFont") as register:
+            register_fonts_from_paths(VERA, font_name="Shaped")
+            register_fonts_from_paths(VERA, font_name="Unshaped")
+
+            fonts = [args[0] for args, kwargs in register.call_args_list]
+            self.assertEqual(len(fonts), 8)
+            for font in fonts:
+                reference = ttfonts.TTFont(font.fontName, VERA)
+                self.assertEqual(font.shapable, reference.shapable)
+                self.assertEqual(
+                    getattr(font, "_shapable", None),
+                    getattr(reference, "_shapable", None),
+                )
+                self.assertEqual(font._asciiReadable, reference._asciiReadable)
+
+    def test_write_failure(self):
+        os.rmdir(self.cache_dir)
+        register_fonts_from_paths(VERA, font_name="CacheTest", cache_dir=self.cache_dir)
+        os.mkdir(self.cache_dir)
+
+
+def report(pdf, lines, restart=False, bottom_table=False, keeptogether=False):
+    pdf.h1("Report with %d lines" % lines)
+    if keeptogether:
+        pdf.start_keeptogether()
+    for i in range(lines):
+        pdf.p("Line %d" % i)
+    if restart:
+        pdf.restart()
+        pdf.p("Restarted")
+    if bottom_table:
+        pdf.bottom_table([["Total", "%d" % lines]], (10 * cm, 4 * cm))
+
+
+class ResetTest(TestCase):
+    def setUp(self):
+        self._invariant = rl_config.invariant
+        rl_config.invariant = 1
+
+    def tearDown(self):
+        rl_config.invariant = self._invariant
+
+    def fresh(self, init="init_report", **kwargs):
+        f = BytesIO()
+        pdf = PDFDocument(f)
+        getattr(pdf, init)()
+        report(pdf, **kwargs)
+        pdf.generate()
+        return f.getvalue()
+
+    def assertResetMatchesFresh(self, pdf, documents, init="init_report"):
+        for kwargs in documents:
+            f = BytesIO()
+            pdf.reset(f)
+            report(pdf, **kwargs)
+            pdf.generate()
+            self.assertEqual(f.getvalue(), self.fresh(init, **kwargs), kwargs)
+
+    def test_no_state_leaks(self):
+        documents = [
+            dict(lines=200, restart=True, bottom_table=True),
+            dict(lines=5),
+            dict(lines=120, bottom_table=True),
+            dict(lines=5, restart=True),
+            dict(lines=5),
+        ]
+
+        for init in ("init_report", "init_letter", "init_confidential_report"):
+            pdf = PDFDocument(BytesIO())
+            getattr(pdf, init)()
+            self.assertResetMatchesFresh(pdf, documents, init)
+
+    def test_unfinished_keeptogether(self):
+        pdf = PDFDocument(BytesIO())
+        pdf.init_report()
+        pdf.start_keeptogether()
+        pdf.p("Never generated")
+        self.assertResetMatchesFresh(pdf, [dict(lines=5, keeptogether=False)])
+        self.assertFalse(hasattr(pdf, "keeptogether_index"))
+
+    def test_after_limit_exceeded(self):
+        pdf = PDFDocument(BytesIO(), max_pages=3)
+        pdf.init_report()
+        report(pdf, lines=500, bottom_table=True)
+        with self.assertRaises(LimitExceeded):
+            pdf.generate()
+
+        self.assertResetMatchesFresh(pdf, [dict(lines=100, bottom_table=True)])
+
+    def test_custom_templates(self):
+        pdf = PDFDocument(BytesIO())
+        pdf.generate_style()
+        pdf.doc.addPageTemplates(
+            [PageTemplate(id="Only", frames=[Frame(2 * cm, 2 * cm, 17 * cm, 25 * cm)])]
+        )
+
+        for lines in (100, 5):
+            pdf.reset(BytesIO())
+            self.assertEqual(pdf.story, [])
+            report(pdf, lines=lines)
+            pdf.generate()
+
+
+class AddressesTest(TestCase):
+    def build_labels(self, *chunks):
+        """
+        Call ``addresses`` with each chunk of keyword arguments on a 2x2
+        label grid and return the first line and frame of every address
+        """
+        pdf = PDFDocument(BytesIO())
+        pdf.init_labels(columns=2, rows=2)
+
+        blocks = []
+        after_flowable = pdf.doc.afterFlowable
+
+        def _after_flowable(flowable):
+            if isinstance(flowable, TextBlock):
+                frame = pdf.doc.frame
+                blocks.append((flowable.lines[0], (pdf.doc.page, frame._x1, frame._y1)))
+            after_flowable(flowable)
+
+        pdf.doc.afterFlowable = _after_flowable
+
+        for chunk in chunks:
+            pdf.addresses(**chunk)
+        pdf.generate()
+        return pdf, blocks[-len(blocks) // 2 :]
+
+    def test_chunks(self):
+        pdf, blocks = self.build_labels(
+            {"data": {"company": ["Co 1", "Co 2", "Co 3"], "city": ["A", "B", "C"]}},
+            {
+                "data": [("Co 4", "D"), ("Co 5", "E"), ("Co 6", "F")],
+                "fields": ("company", "city"),
+            },
+        )
+        self.assertEqual(
+            [line for line, frame in blocks],
+            ["Co 1", "Co 2", "Co 3", "Co 4", "Co 5", "Co 6"],
+        )
+        # Every address is in its own frame
+        self.assertEqual(len(set(frame for line, frame in blocks)), 6)
+        self.assertEqual(pdf.doc.numPages, 2)
+
+    def test_shrink(self):
+        pdf, blocks = self.build_labels(
+            {
+                "data": {
+                    "full_override": [
+                        "\n".join("Line %d" % i for i in range(30)),
+                        "Next",
+                    ]
+                }
+            }
+        )
+        self.assertEqual([line for line, frame in blocks], ["Line 0", "Next"])
+        self.assertNotEqual(blocks[0][1], blocks[1][1])
+        self.assertEqual(pdf.doc.numPages, 1)
+
+    def test_invalid(self):
+        pdf = PDFDocument(BytesIO())
+        pdf.init_labels()
+        with self.assertRaises(ValueError):
+            pdf.addresses({"company": ["A", "B", "C"], "last_name": ["x"]})
+        with self.assertRaises(ValueError):
+            pdf.addresses([("A", "x"), ("B",)], fields=("company", "last_name"))
+        with self.assertRaises(ValueError):
+            pdf.addresses([("A", "x")], fields=("company", "lastname"))
+        with self.assertRaises(ValueError):
+            pdf.addresses({"compnay": ["A"]})
+        pdf.addresses([])
+        self.assertEqual(len(pdf.story), 1)
+
+
+class StatsTest(TestCase):
+    def setUp(self):
+        collector.reset()
+
+    def test_stats(self):
+        f = BytesIO()
+        pdf = PDFDocument(f)
+        pdf.init_letter()
+        report(pdf, lines=100)
+        stats = pdf.generate()
+
+        self.assertIs(stats, pdf.stats)
+        self.assertEqual(stats.template, "letter")
+        self.assertEqual(stats.outcome, "success")
+        self.assertEqual(stats.pages, 2)
+        self.assertEqual(stats.passes, 2)
+        self.assertEqual(stats.bytes, len(f.getvalue()))
+
+        pdf = PDFDocument(BytesIO(), max_pages=1)
+        pdf.init_report()
+        report(pdf, lines=100)
+        with self.assertRaises(LimitExceeded):
+            pdf.generate()
+        self.assertEqual(pdf.stats.outcome, "limit_exceeded")
+        self.assertIsNone(pdf.stats.bytes)
+
+        data = collector.dump()
+        self.assertEqual(data["documents"], 2)
+        self.assertEqual(data["templates"]["letter"]["success"]["documents"], 1)
+        self.assertEqual(data["templates"]["report"]["limit_exceeded"]["documents"], 1)
+
+        text = collector.prometheus()
+        self.assertIn("# TYPE pdfdocument_documents_total counter\n", text)
+        self.assertIn("# TYPE pdfdocument_document_pages histogram\n", text)
+        self.assertIn(
+            'pdfdocument_documents_total{template="report",outcome="limit_exceeded"}'
+            " 1\n",
+            text,
+        )
+
+
+class LimitsTest(TestCase):
+    def generate(self, build_story, **kwargs):
+        pdf = PDFDocument(BytesIO(), **kwargs)
+        pdf.init_report()
+        build_story(pdf)
+        with self.assertRaises(LimitExceeded) as cm:
+            pdf.generate()
+        return pdf, cm.exception
+
+    def test_max_pages(self):
+        pdf, exc = self.generate(lambda pdf: report(pdf, lines=200), max_pages=2)
+        self.assertEqual((exc.limit, exc.maximum, exc.value), ("pages", 2, 3))
+        self.assertEqual(exc.passes, 1)
+        self.assertIn(exc.flowable, pdf.story)
+        self.assertIs(pdf.story[exc.index], exc.flowable)
+
+    def test_max_passes(self):
+        pdf, exc = self.generate(lambda pdf: report(pdf, lines=10), max_passes=1)
+        self.assertEqual((exc.limit, exc.maximum, exc.value), ("passes", 1, 2))
+        self.assertEqual((exc.page, exc.passes), (0, 2))
+        self.assertIsNone(exc.flowable)
+        self.assertIsNone(exc.index)
+        self.assertNotIn("on page", str(exc))
+
+    def test_time_limit(self):
+        # A clock advancing by one second every time it is read
+        with mock.patch("pdfdocument.document.time") as time:
+            time.time.side_effect = range(1000)
+            pdf, exc = self.generate(lambda pdf: report(pdf, lines=500), time_limit=20)
+        self.assertEqual((exc.limit, exc.maximum, exc.value), ("time", 20, 21))
+        self.assertEqual(exc.passes, 1)
+        self.assertIs(pdf.story[exc.index], exc.flowable)
+
+    def test_max_story_size(self):
+        pdf, exc = self.generate(lambda pdf: report(pdf, lines=10), max_story_size=5)
+        self.assertEqual((exc.limit, exc.maximum), ("story size", 5))
+        self.assertEqual(exc.value, len(pdf.story))
+        self.assertEqual((exc.page, exc.passes), (0, 1))
+        self.assertIsNone(exc.flowable)
+
+    def test_index_of_split_flowables(self):
+        def build_story(pdf):
+            pdf.p("Before")
+            pdf.start_keeptogether()
+            for i in range(300):
+                pdf.p("Line %d" % i)
+            pdf.end_keeptogether()
+            pdf.table([["Row %d" % i, "x"] for i in range(300)], (5 * cm, 5 * cm))
+
+        pdf, exc = self.generate(build_story, max_pages=2)
+        self.assertEqual(exc.index, 2)
+        self.assertIsInstance(pdf.story[2], KeepTogether)
+        self.assertIn("story item 2:", str(exc))
+
+        pdf, exc = self.generate(build_story, max_pages=8)
+        self.assertEqual(exc.index, 3)
+        self.assertIsInstance(pdf.story[3], Table)
+        self.assertIsInstance(exc.flowable, Table)